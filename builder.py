@@ -5,7 +5,10 @@ Copyright (c) 2022, vcsaturninus -- vcsaturninus@protonmail.com
 """
 
 import argparse
+import concurrent.futures
+import functools
 import os
+import stat
 import sys
 import shutil
 
@@ -19,50 +22,70 @@ def clean_up_paths(paths):
         shutil.rmtree(path, ignore_errors=True)
         os.makedirs(path)
 
+@functools.lru_cache(maxsize=None)
 def load_known_targets(tgroot):
     """
     List targets that are currently supported i.e. can be built.
+    The target root is fixed for the lifetime of the process so the
+    result is cached and the directory is only scanned once.
     """
-    return {x : True for x in os.listdir(tgroot) if os.path.isdir(tgroot + "/" + x) and x != "common"}
+    with os.scandir(tgroot) as it:
+        return {e.name for e in it if e.is_dir(follow_symlinks=False) and e.name != "common"}
 
 def print_known_targets(tgroot):
-    targets = load_known_targets(tgroot).keys()
-    if not len(targets):
+    targets = load_known_targets(tgroot)
+    if not targets:
         print("No support for any targets")
     else:
         print("Supported targets:")
-        for tg in targets:
+        for tg in sorted(targets):
             print(f"\t ** {tg}")
 
 def is_known_target(target):
-    return bool(load_known_targets(tgroot).get(target))
+    return target in load_known_targets(tgroot)
+
+def list_json_subjects(ignore_missing_specs):
+    """
+    Walk the spec directories once, yielding a (kind, path) tuple for
+    every json file that must be validated against its schema.
+    """
+    for kind, path in (("steps", steps_dir), ("common", f"{tgroot}common/specs/")):
+        with os.scandir(path) as it:
+            for entry in it:
+                yield kind, entry.path
+
+    for target in sorted(load_known_targets(tgroot)):
+        target_dir = f"{tgroot}{target}"
+        tgspec = f"{target}_spec.json"
+        with os.scandir(target_dir) as sub:
+            names = {e.name for e in sub if not e.is_dir()}
+        if tgspec not in names:
+            print(f"Target {target} missing '{tgspec}'")
+            if not ignore_missing_specs:
+                raise FileNotFoundError
+        else:
+            yield "target", f"{target_dir}/{tgspec}"
+
+def validate_json_file(subject):
+    return utils.validate_json_against_schema(subject, schemas_dir)
 
 def validate_json_files(ignore_missing_specs):
-    paths = { "steps" : steps_dir, "common" : tgroot + "common/specs/" }
-    for key,path in paths.items():
-        print(f"Validating {key} specs ...")
-        for file in os.listdir(path):
-            subject = path + file
-            utils.validate_json_against_schema(subject, schemas_dir)
+    subjects = list(list_json_subjects(ignore_missing_specs))
+    # the files are independent of each other: validate them concurrently
+    # but report the results in order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(validate_json_file, [subject for _, subject in subjects])
+        current_kind = None
+        for (kind, subject), _ in zip(subjects, results):
+            if kind != current_kind:
+                current_kind = kind
+                print(f"Validating {kind} specs ...")
             print(f" # {subject} : valid.")
 
-    print("Validating target specs ...")
-    for directory in os.listdir(tgroot):
-        if directory != "common":
-            tgspec = f"{directory}_spec.json"
-            subject = tgroot + directory + "/" + tgspec
-            if not os.path.isfile(subject):
-                print(f"Target {directory} missing '{tgspec}'")
-                if not ignore_missing_specs:
-                    raise FileNotFoundError
-            else:
-                utils.validate_json_against_schema(subject, schemas_dir)
-                print(f" # {subject} : valid.")
-
     if developer_config:
         print(f"Validating {developer_config} ...")
         subject = developer_config
-        utils.validate_json_against_schema(subject, schemas_dir)
+        utils.validate_json_against_schema(subject, schemas_dir, instance=load_cached_json(subject))
         print(f" # {subject} : valid.")
 
 def dispatch_tasks(tasks, context):
@@ -72,38 +95,82 @@ def dispatch_tasks(tasks, context):
             utils.log(f" > Step: {task} [{context}]")
             sdk.execute_task(task)
 
+@functools.lru_cache(maxsize=None)
+def load_cached_json(path):
+    """
+    Parse the json file at path. Each file is read at most once per invocation.
+    """
+    return utils.load_json_from_file(path)
+
 def load_env_defaults():
-    j = utils.load_json_from_file(env_defaults_file)
+    j = load_cached_json(env_defaults_file)
     return j["variables"]
 
 def load_env_overrides():
     env = {}
     if not developer_config:
         return env
-    j = utils.load_json_from_file(developer_config)
+    j = load_cached_json(developer_config)
     env = j["environment"]["variables"]
     return env
 
 def load_mount_overrides():
-    mounts = []
     if not developer_config:
-        return mounts
-    j = utils.load_json_from_file(developer_config)
+        return []
+    j = load_cached_json(developer_config)
     # convert to list of three-tuples as expected by sdk class
     # all target mounts are relative to the container home dir
     # unless the first character is a '/'
-    prefix = paths.get('container', 'home')
-    for label, spec in j["mounts"].items():
-        target_path = spec['target']
-        if not os.path.isabs(target_path):
-            target_path = prefix + target_path
-        mounts.append( (spec['source'], target_path, spec['type']) )
-    return mounts
+    prefix = container_home
+    return [(spec['source'],
+             spec['target'] if os.path.isabs(spec['target']) else prefix + spec['target'],
+             spec['type']) for spec in j["mounts"].values()]
 
 def load_mount_defaults():
     """ Currently unused """
     return []
 
+def do_list_targets():
+    print_known_targets(tgroot)
+
+def do_validate():
+    validate_json_files(ignore_missing_specs=False)
+
+def do_build_packages(sdk):
+    sdk.build_single_packages(only_packages)
+    sdk.retrieve_build_artifacts(container_pkg_outdir)
+
+def do_build_firmware(sdk):
+    sdk.build_only_firmware()
+    sdk.retrieve_build_artifacts(container_outdir)
+
+def do_interactive_container(sdk):
+    sdk.get_interactive_container(ephemeral=ephemeral)
+
+def do_populate_staging(sdk):
+    # asked for explicitly, so populate even if staging looks up to date
+    sdk.populate_staging_dir(force=True)
+
+def do_full_build(sdk):
+    dispatch_tasks(steps["steps"], current_context)
+
+# actions selected by command line options, in order of precedence
+# (option dest -> handler). The first action whose option is set is run.
+standalone_actions = {
+        'list_targets'     : do_list_targets,
+        'validate_jsons'   : do_validate,
+        }
+
+sdk_actions = {
+        'only_packages'    : do_build_packages,
+        'only_firmware'    : do_build_firmware,
+        'container'        : do_interactive_container,
+        'populate_staging' : do_populate_staging,
+        }
+
+def select_action(actions, options, default=None):
+    return next((handler for option, handler in actions.items() if options.get(option)), default)
+
 def sanitize_cli(argv):
     unsane = False
     if argv.verbose and argv.quiet:
@@ -148,12 +215,26 @@ parser.add_argument('--clean',
                      help='Start clean'
                      )
 
+parser.add_argument('--fresh-clone',
+                     action='store_true',
+                     dest='fresh_clone',
+                     help='Delete the sdk and clone it again from scratch. By default --clean \
+                             only resets and cleans the existing sdk checkout'
+                     )
+
 parser.add_argument('--validate',
                      action='store_true',
                      dest='validate_jsons',
                      help='Validate all json files against their schemas'
                      )
 
+parser.add_argument('--trust-validated',
+                     action='store_true',
+                     dest='trust_validated',
+                     help='Skip validating json files that already passed validation and have not \
+                             changed since (nor have the schemas)'
+                     )
+
 parser.add_argument('--list-targets',
                      action='store_true',
                      dest='list_targets',
@@ -213,40 +294,58 @@ os.chdir(utils.get_project_root())
 args = parser.parse_args()
 sanitize_cli(args)
 
+# bind the command line options once rather than going through the namespace each time
+(devbuild, target_arg, quiet, verbose_flag, clean, fresh_clone, validate_jsons, trust_validated,
+ list_targets, num_cores, only_firmware, only_packages, want_container, ephemeral,
+ devconfig, populate_staging) = (args.devbuild, args.target, args.quiet, args.verbose,
+                                 args.clean, args.fresh_clone, args.validate_jsons, args.trust_validated,
+                                 args.list_targets, args.num_build_cores, args.only_firmware,
+                                 args.only_packages, args.container, args.ephemeral,
+                                 args.devconfig, args.populate_staging)
+
 # guards for certain actions and prints
-build_mode  = not (args.populate_staging or args.container or args.list_targets or args.validate_jsons)
+build_mode  = not (populate_staging or want_container or list_targets or validate_jsons)
 
-interactive = args.container
+interactive = want_container
 # excessive verbosity is inconvenient by default
-verbose    = not args.quiet and (build_mode or args.verbose)
+verbose    = not quiet and (build_mode or verbose_flag)
 utils.set_logging(tostdout=verbose, tofile=not containers.inside_container())
-restricted_build   = args.only_packages or args.only_firmware
-
-paths              = settings.set_paths(args.target)
-start_clean        = args.clean
-steps_file         = paths.dev_build_steps if args.devbuild else paths.automated_build_steps
-sdk_build_type     = "dev" if args.devbuild else "automated"
-num_build_cores    = args.num_build_cores or 1
+utils.set_validation_cache(trust_validated)
+restricted_build   = only_packages or only_firmware
+
+paths              = settings.set_paths(target_arg)
+current_context    = paths.get_current_context()
+container_home     = paths.get('container', 'home')
+container_outdir   = paths.get('container', 'outdir')
+container_pkg_outdir = paths.get('container', 'pkg_outdir')
+start_clean        = clean
+steps_file         = paths.dev_build_steps if devbuild else paths.automated_build_steps
+sdk_build_type     = "dev" if devbuild else "automated"
+num_build_cores    = num_cores or 1
 schemas_dir        = paths.schemas
 steps_dir          = paths.steps_dir
 env_defaults_file  = paths.env_defaults
-tgroot             = paths.tgroot
-developer_config   = args.devconfig if args.devconfig else paths.get(paths.get_current_context(), 'devconfig', True)
-developer_config   = developer_config if os.path.isfile(developer_config) else None
+tgroot             = paths.tgroot.rstrip('/') + '/'
+developer_config   = devconfig or paths.get(current_context, 'devconfig', True) or None
+try:
+    # one stat tells us both whether the config exists and whether it is a regular file
+    if not stat.S_ISREG(os.stat(developer_config).st_mode):
+        developer_config = None
+except (OSError, TypeError):
+    developer_config = None
 if developer_config and ((build_mode or interactive) and sdk_build_type != 'dev'):
     raise ValueError("Developer configs can only be used for dev containers")
 
-if args.list_targets:
-    print_known_targets(paths.tgroot)
-elif args.validate_jsons:
-    validate_json_files(ignore_missing_specs=False)
+action = select_action(standalone_actions, vars(args))
+if action:
+    action()
 else:
-    target = args.target.lower() if args.target else None
+    target = target_arg.lower() if target_arg else None
     if not target:
         print("Mandatory argument not specified: '-t|--target'")
         sys.exit(13)
     elif not is_known_target(target):
-        print_known_targets(paths.tgroot)
+        print_known_targets(tgroot)
         raise LookupError(f"Target specified ('{target}') not supported")
     
     paths_to_clean = [paths.tmpdir]
@@ -258,8 +357,9 @@ else:
     utils.log(f" ** SDK type:   '{sdk_build_type}'")
     utils.log(f" ** SDK target: '{target}'")
 
-    tgspec_file = paths.tgspec
-    tgspec_file = paths.tgroot + f"{target}/{target}_spec.json"
+    # is_known_target() has already confirmed this directory exists
+    target_dir  = f"{tgroot}{target}"
+    tgspec_file = f"{target_dir}/{target}_spec.json"
 
     utils.log(f" > Validating {tgspec_file} against schema ...")
     tgspec = utils.validate_json_against_schema(tgspec_file, schemas_dir)
@@ -269,12 +369,13 @@ else:
     
     if developer_config:
         utils.log(f" > Validating {developer_config} against schema ...")
-        utils.validate_json_against_schema(developer_config, schemas_dir)
+        utils.validate_json_against_schema(developer_config, schemas_dir, instance=load_cached_json(developer_config))
 
     confvars = {
             'sdk_build_type'    : sdk_build_type,
             'num_build_cores'   : str(num_build_cores),
             'start_clean'       : start_clean,
+            'force_fresh_clone' : fresh_clone,
             'verbose'           : verbose,
             "build_artifacts_archive_name": tgspec["build_artifacts_archive_name"],
             "build_user"        : settings.build_user,
@@ -292,18 +393,5 @@ else:
     utils.log(f" ** mounts: {sdk.get_mounts(validate=False)}")
     utils.log(f" ** confvars: {confvars}")
 
-    if args.only_packages:
-        sdk.build_single_packages(args.only_packages)
-        sdk.retrieve_build_artifacts(paths.get('container', 'pkg_outdir'))
-    elif args.only_firmware:
-        sdk.build_only_firmware()
-        sdk.retrieve_build_artifacts(paths.get('container', 'outdir'))
-    elif args.container:
-        sdk.get_interactive_container(ephemeral=args.ephemeral)
-    elif args.populate_staging:
-        sdk.populate_staging_dir()
-    else: # full sdk build
-        tasks=steps["steps"]
-        context = paths.get_current_context()
-        dispatch_tasks(tasks, context)
-
+    action = select_action(sdk_actions, vars(args), default=do_full_build)
+    action(sdk)
@@ -4,11 +4,12 @@ Abstraction layer for interacting with varying container/jail OS technologies.
 
 from abc import ABC, abstractmethod
 import os
-
-import docker
+import shlex
 
 import utils
 
+# docker is imported lazily by the methods that use it (see containers.py)
+
 class Container(ABC):
     @abstractmethod
     def set_mount_configs(self, mounts):
@@ -49,6 +50,7 @@ class Container(ABC):
 
 class Docker(Container):
     def __init__(self, img, env=None, interactive=False, ephemeral=False):
+        import docker
         self.client     = docker.client.from_env()
         self.container  = None
         self.image      = img
@@ -61,6 +63,7 @@ class Docker(Container):
         self.exitcode  = 0
 
     def set_mounts(self, mounts):
+        import docker
         for host_path, container_path, mount_type in mounts:
             mount = docker.types.Mount(
                     source=host_path,
@@ -76,14 +79,17 @@ class Docker(Container):
         There's no simple way to get a cli-interactive container instance via the python API.
         As such,  we'll need to call the docker cli client instead in a subprocesss.
         """
-        cli = f"docker run {'--rm' if self.ephemeral else ''} --net=host"
+        parts = ["docker", "run"]
+        if self.ephemeral:
+            parts.append("--rm")
+        parts.append("--net=host")
         for k,v in self.env.items():
-            cli += f" -e '{k}={v}'"
+            parts += ["-e", f"{k}={v}"]
         for host_path,container_path,mount_type in self.mount_tuples:
-            cli += f" --mount type='{mount_type}',source='{host_path}',target='{container_path}'"
-        cli += f" -it {self.image} {cmd}"
+            parts += ["--mount", f"type={mount_type},source={host_path},target={container_path}"]
+        parts += ["-it", self.image, *shlex.split(cmd)]
 
-        rc = utils.interact(cli)
+        rc = utils.interact(parts)
         self.exited=True
         self.exitcode = rc
 
@@ -105,9 +111,20 @@ class Docker(Container):
     def logs(self):
         if self.interactive:
             raise RuntimeError("Interactive containers do not return logs")
-        logs = self.container.logs(stream=True)
-        for log in logs:
-            yield log.decode('utf8').rstrip()
+        # the stream hands back arbitrary fragments of output; gather the raw
+        # bytes and only decode once a whole line is available
+        buf = bytearray()
+        for chunk in self.container.logs(stream=True):
+            buf += chunk
+            start = 0
+            nl = buf.find(b'\n')
+            while nl != -1:
+                yield buf[start:nl].decode('utf8', errors='replace').rstrip()
+                start = nl + 1
+                nl = buf.find(b'\n', start)
+            del buf[:start]
+        if buf:
+            yield buf.decode('utf8', errors='replace').rstrip()
     
     def wait(self):
         if self.exited:
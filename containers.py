@@ -5,10 +5,21 @@ Abstraction layer for interacting with varying container/jail OS technologies.
 from abc import ABC, abstractmethod
 import os
 
-import docker
+try:
+    # considerably faster than the json module docker-py would decode with
+    import orjson as jsonlib
+except ImportError:
+    import json as jsonlib
 
 import container
 
+# NOTE: the docker SDK is slow to import and many invocations (e.g. --list-targets,
+# --validate) never use it, so it is only imported by the methods that need it.
+
+# size of the chunks requested when streaming archives out of a container
+# and of the write buffer used when saving them
+ARCHIVE_BUFSIZE = 4 << 20
+
 class Containers(ABC):
     @abstractmethod
     def image_exists(self, imgid):
@@ -47,6 +58,7 @@ class Containers(ABC):
 
 class Docker_containers(Containers):
     def __init__(self, container_tech):
+        import docker
         self.api  = docker.client.from_env()
         self.tech = container_tech
 
@@ -59,6 +71,7 @@ class Docker_containers(Containers):
         :return         Boolean indicating whether the image exists or not.
         :rtype          bool
         """
+        import docker
         client = self.api
         try:
             client.images.get(imgid)
@@ -76,6 +89,7 @@ class Docker_containers(Containers):
         :return         Boolean indicating whether the container exists or not.
         :rtype          bool
         """
+        import docker
         client = self.api
         try:
             client.containers.get(contid)
@@ -88,16 +102,15 @@ class Docker_containers(Containers):
         """
         Create ephemeral container for copying single file/dir out of image.
         """
+        import docker
         if not self.image_exists(imgid):
             raise docker.errors.ImageNotFound
 
         client = self.api
-        container = client.containers.run(command="bash", detach=True, auto_remove=False, image=imgid)
-        bytes_, stats = container.get_archive(src)
-        with open(dst, "wb") as tar:
-            for byte in bytes_:
-                tar.write(byte)
-        container.stop()
+        # the container is only needed as a handle for get_archive: create it but never start it
+        container = client.containers.create(image=imgid, command="bash")
+        bytes_, stats = container.get_archive(src, chunk_size=ARCHIVE_BUFSIZE)
+        save_archive(bytes_, dst)
         container.remove(force=True)
         return bytes_, stats
 
@@ -105,14 +118,13 @@ class Docker_containers(Containers):
         """
         Copy single file/dir out of existing (running or stopped) container.
         """
+        import docker
         if not self.container_exists(contid):
             raise docker.errors.NotFound
         client = self.api
         container = client.containers.get(contid)
-        bytes_, stats = container.get_archive(src)
-        with open(dst, "wb") as tar:
-            for byte in bytes_:
-                tar.write(byte)
+        bytes_, stats = container.get_archive(src, chunk_size=ARCHIVE_BUFSIZE)
+        save_archive(bytes_, dst)
         if remove_container:
             container.remove(force=True)
         return bytes_, stats
@@ -121,11 +133,12 @@ class Docker_containers(Containers):
         return container.get(self.tech)(*args, **kwargs)
 
     def build_image(self, start_clean, container_config, tag=None, **kwargs):
+        import docker
         uds_uri = 'unix://var/run/docker.sock'
         docker_client = docker.APIClient(base_url=uds_uri)
         nocache = bool(start_clean)
         stream = docker_client.build(
-            decode=True, # decode the stream to dictionaries on the fly
+            decode=False, # the raw json messages are decoded below
             tag = tag,
             path = container_config,
             buildargs = kwargs,
@@ -133,11 +146,23 @@ class Docker_containers(Containers):
             network_mode='host',
             rm=True
             )
-        for chunk in stream:
-            if 'stream' in chunk:
-                line=chunk['stream'].rstrip()
+        # each json message is terminated by a newline but the messages
+        # may be split up or batched together arbitrarily in the raw stream
+        buf = b''
+        for raw in stream:
+            # docker-py hands back the whole body as text when the
+            # response isn't chunked, and bytes otherwise
+            if isinstance(raw, str):
+                raw = raw.encode('utf8')
+            buf += raw
+            *messages, buf = buf.split(b'\n')
+            for message in messages:
+                line = decode_build_message(message)
                 if line:
                     yield line
+        line = decode_build_message(buf)
+        if line:
+            yield line
  
 
 class ImageNotFound(LookupError):
@@ -147,6 +172,25 @@ class ContainerNotFound(LookupError):
     pass
 
 
+def decode_build_message(message):
+    """
+    Return the output line carried by a raw json message from the image build
+    stream or None if there isn't one e.g. for progress or status messages.
+    """
+    if not message.strip():
+        return None
+    text = jsonlib.loads(message).get('stream')
+    return text.rstrip() if text else None
+
+def save_archive(stream, dst):
+    """
+    Write the chunks of an archive stream (as returned by get_archive) to dst.
+    Small chunks are coalesced in a large write buffer to cut down on write calls.
+    """
+    with open(dst, "wb", buffering=ARCHIVE_BUFSIZE) as tar:
+        for chunk in stream:
+            tar.write(chunk)
+
 def inside_container():
     """
     True if currently running inside a container, else False.
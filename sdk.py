@@ -3,12 +3,14 @@ Abstraction layer for varying build Sdks.
 """
 
 from abc import ABC, abstractmethod
+import functools
 import pathlib
 import shutil
 import os
+import shlex
 import sys
-import glob
-from datetime import datetime
+import threading
+import time
 
 import utils
 import containers
@@ -94,6 +96,7 @@ class Concrete_sdk(Sdk):
         self.containers        = containers.get_interface_to(self.conf['container_tech'])
         self.container_img_tag = f"{self.name}_{self.tag}:latest_{self.build_type}_{self.target}".lower()
         self.container = None
+        self.inherited_env = os.environ.copy()
         self.set_start_timestamp()
 
     def set_start_timestamp(self):
@@ -107,40 +110,84 @@ class Concrete_sdk(Sdk):
             self.save(f"Completed:  {self.get_time_string()}", self.paths.timestamp)
 
     def checkout(self):
-        pabs = self.path.absolute()
-        cmd  = f"git clone {self.url} --branch {self.tag} {pabs}"
+        pabs = str(self.path.absolute())
+        git  = ["git", "-C", pabs]
 
-        if self.path.exists():
-            cmd = f"git -C {pabs} checkout {self.tag}"
-            if self.conf["start_clean"]:
-                shutil.rmtree(pabs)
+        if self.path.exists() and self.conf["force_fresh_clone"]:
+            shutil.rmtree(pabs)
 
         if not self.path.exists():
             self.path.mkdir(parents=True, exist_ok=True)
+            cmds = [["git", "clone", self.url, "--branch", self.tag, pabs]]
+        elif self.conf["start_clean"]:
+            # reset the existing checkout to the upstream tag or branch tip
+            # rather than cloning again: this throws away all local changes
+            # but keeps the objects already fetched
+            cmds = [git + ["fetch", "--tags", "origin"],
+                    git + ["fetch", "origin", self.tag],
+                    git + ["checkout", "--force", self.tag],
+                    git + ["reset", "--hard", "FETCH_HEAD"],
+                    git + ["clean", "-xdf"]]
+        else:
+            cmds = [git + ["checkout", self.tag]]
 
-        utils.log(f"Running {cmd} ...")
-        utils.run(cmd)
+        for cmd in cmds:
+            utils.log(f"Running {shlex.join(cmd)} ...")
+            utils.run(cmd)
     
-    def get_env_vars(self, inherit=True):
-        inherited   = dict(**os.environ if inherit else {})
-        defaults    = self.conf.get("env_defaults")  or {}
-        specifics   = self.env
-        overrides   = self.conf.get("env_overrides") or {}
+    @functools.cached_property
+    def container_paths(self):
+        """
+        Paths inside the container that are referred to repeatedly. They do not
+        change over the lifetime of the sdk object so they are only resolved once.
+        """
+        paths = self.paths.clone(context='container')
+        return {
+                "basedir"    : paths.basedir,
+                "outdir"     : paths.outdir,
+                "pkg_outdir" : paths.pkg_outdir,
+                "files"      : paths.files,
+                "sdk_path"   : paths.sdk_path,
+                }
 
+    @functools.cached_property
+    def configured_env(self):
+        """
+        The environment variables derived from the sdk configuration.
+        """
+        paths = self.container_paths
         configured  = {}
-        paths = self.paths.clone(context='container')
         #configured["VERBOSE"] = "Y" if self.conf.get("verbose") else ''
         configured["VERBOSE"] = "Y" 
-        configured["BUILD_ARTIFACTS_OUTDIR"] = paths.outdir
-        configured["PACKAGE_OUTDIR"] = self.paths.get(context='container', label='pkg_outdir')
+        configured["BUILD_ARTIFACTS_OUTDIR"] = paths["outdir"]
+        configured["PACKAGE_OUTDIR"] = paths["pkg_outdir"]
         configured["NUM_BUILD_CORES"] = self.conf["num_build_cores"]
-        configured["PYTHONPATH"] = (os.getenv("PYTHONPATH") or '') + ":" + paths.basedir
-        configured["CONFIGS_DIR"] = paths.files
-        configured["SDK_TOPDIR"] = paths.sdk_path + self.dir_name
+        configured["PYTHONPATH"] = (os.getenv("PYTHONPATH") or '') + ":" + paths["basedir"]
+        configured["CONFIGS_DIR"] = paths["files"]
+        configured["SDK_TOPDIR"] = paths["sdk_path"] + self.dir_name
+        return configured
 
-        return {**inherited, **defaults, **configured, **overrides}
+    def refresh_env(self):
+        """
+        Take a new snapshot of the environment, in case os.environ
+        has been modified since the sdk object was created.
+        """
+        self.inherited_env = os.environ.copy()
+        self.__dict__.pop("configured_env", None)
+
+    def get_env_vars(self, inherit=True):
+        inherited   = self.inherited_env if inherit else {}
+        defaults    = self.conf.get("env_defaults")  or {}
+        specifics   = self.env
+        overrides   = self.conf.get("env_overrides") or {}
+
+        return {**inherited, **defaults, **self.configured_env, **overrides}
     
-    def get_mounts(self, validate=True):
+    @functools.cached_property
+    def mounts(self):
+        """
+        The (host path, container path, type) mounts for the container.
+        """
         mounts=[]
         if self.conf["sdk_build_type"] != "dev":
             return mounts
@@ -159,11 +206,22 @@ class Concrete_sdk(Sdk):
         mounts.append(sdk_root)
         mounts.append(staging)
         mounts += self.conf.get('mount_overrides') or {}
-        return utils.validate_mounts(mounts) if validate else mounts
+        return mounts
+
+    @functools.cached_property
+    def validated_mounts(self):
+        """
+        The mounts, once the host paths have been checked. Only cached if
+        the check passes, so a failed check is redone on the next call.
+        """
+        return utils.validate_mounts(self.mounts)
+
+    def get_mounts(self, validate=True):
+        return list(self.validated_mounts if validate else self.mounts)
 
     def run_scripts(self, path):
         scripts = utils.get_sorted_script_list(path)
-        utils.run_commands([f"./{script}" for script in scripts], env=self.get_env_vars(), verbose=self.conf["verbose"])
+        utils.run_script_chain([f"./{script}" for script in scripts], env=self.get_env_vars(), capture=not self.conf["verbose"])
 
     def build(self):
         sdk_type = self.conf["sdk_build_type"]
@@ -177,11 +235,31 @@ class Concrete_sdk(Sdk):
     def run_staged_build(self):
         stages = ["prebuild", "build", "postbuild"]
         for stage in stages:
-            time = datetime.now()
-            time = time.strftime("%H:%M:%S")
-            utils.log(f"============| Stage: {stage} [{time}] |============")
+            now = time.strftime("%H:%M:%S")
+            utils.log(f"============| Stage: {stage} [{now}] |============")
             self.run_scripts("scripts/" + stage)
 
+    def wait_for_container(self, container):
+        """
+        Wait for the container to exit and return its exit code. The container
+        logs are written out on a separate thread in the meantime. Any error
+        raised while writing out the logs is raised again here.
+        """
+        failed = []
+        def drain_logs():
+            try:
+                utils.log_stream(container.logs())
+            except BaseException as e:
+                failed.append(e)
+
+        drain = threading.Thread(target=drain_logs, daemon=True)
+        drain.start()
+        errno = container.wait()
+        drain.join()
+        if failed:
+            raise failed[0]
+        return errno
+
     def build_only_firmware(self):
         utils.log("Restricted firmware-only build using prebuilt sdk .. ")
         if not self.containers.image_exists(self.container_img_tag):
@@ -197,11 +275,7 @@ class Concrete_sdk(Sdk):
         utils.log(f"Starting container with cmd '{cmd}'")
         container.run(cmd)
 
-        logs = container.logs()
-        for line in logs:
-            utils.log(line)
-        
-        errno = container.wait()
+        errno = self.wait_for_container(container)
         utils.log(f"container exited with exit code {errno}: '{os.strerror(errno)}'")
         if errno:
             sys.exit(errno)
@@ -229,10 +303,7 @@ class Concrete_sdk(Sdk):
 
         utils.log(f"Starting container with cmd '{cmd}'")
         container.run(cmd)
-        logs = container.logs()
-        for line in logs:
-            utils.log(line)
-        errno = container.wait()
+        errno = self.wait_for_container(container)
         utils.log(f"container exitted with exit code {errno}: '{os.strerror(errno)}'")
         if errno:
             sys.exit(errno)
@@ -264,9 +335,12 @@ class Concrete_sdk(Sdk):
         #self.container = container
 
 
-    def build_container_image(self):
-        nocache = True if self.conf["start_clean"] else False
-        build_args = {
+    @functools.cached_property
+    def image_build_args(self):
+        """
+        The build arguments passed to the container image build.
+        """
+        return {
                 "UID"     : str(os.getuid()),
                 "GID"     : str(os.getgid()),
                 "USER"    : self.conf["build_user"],
@@ -275,9 +349,13 @@ class Concrete_sdk(Sdk):
                 "TARGET" : self.target,
                 "QUIET_MODE_CLI_FLAG" : not self.conf["verbose"] and "--quiet" or "",
                 "NUM_BUILD_CORES_CLI_FLAG" : "--cores=" + self.conf["num_build_cores"],
-                "BUILD_ARTIFACTS_OUTDIR" : self.paths.get(context='container', label='outdir'),
+                "BUILD_ARTIFACTS_OUTDIR" : self.container_paths["outdir"],
                 "DEV_BUILD_CLI_FLAG" : (self.conf["sdk_build_type"] == "dev") and "-d" or ""
                 }
+
+    def build_container_image(self):
+        nocache = True if self.conf["start_clean"] else False
+        build_args = self.image_build_args
         print(build_args)
         stream = self.containers.build_image(
                 nocache,
@@ -285,54 +363,107 @@ class Concrete_sdk(Sdk):
                 tag = self.container_img_tag,
                 **build_args
                 )
-        for line in stream:
-            utils.log(line)
+        utils.log_stream(stream)
     
 
-    def populate_staging_dir(self):
+    def populate_staging_dir(self, force=False):
+        """
+        Copy everything needed inside the container image into the staging
+        directory. Skipped if it is already up to date, unless force=True.
+        """
         current  = self.paths
-        staging  = current.clone(context='staging')
-
-        shutil.rmtree(staging.basedir, ignore_errors=True)
-        os.mkdir(staging.basedir)
-
-        # bare sdk files to continue inside container
-        utils.cp_dir(current.depends, staging.depends, just_contents=True)
-        utils.cp_dir(current.schemas, staging.schemas, just_contents=True)
-        utils.cp_dir(current.steps_dir, staging.steps_dir, just_contents=True)
-        utils.cp_file(current.tgspec, staging.target, must_exist=True)
-        utils.cp_file(current.env_defaults, staging.common + 'specs/', must_exist=True)
-        utils.cp_file(current.common_hooks + "run_hooks.py", staging.hooks, must_exist=True)
-
-        # common build materials
-        utils.cp_dir(current.common_files + f"system_config/common", staging.files + "system_config", just_contents=True)
-        utils.cp_dir(current.common_files + f"sdk_config/common", staging.files + "system_config", just_contents=True)
-        utils.cp_dir(current.common_scripts + "prebuild/common", staging.scripts + "prebuild", just_contents=True)
-        utils.cp_dir(current.common_scripts + "build/common", staging.scripts + "build", just_contents=True)
-        utils.cp_dir(current.common_scripts + "postbuild/common", staging.scripts + "postbuild", just_contents=True)
-        utils.cp_dir(current.common_hooks + "prepare_system/common", staging.hooks + "prepare_system", just_contents=True)
-        utils.cp_dir(current.common_hooks + "prepare_sdk/common", staging.hooks + "prepare_sdk", just_contents=True)
-        utils.cp_dir(current.common_hooks + "install_configs/common", staging.hooks + "install_configs", just_contents=True)
-        utils.cp_dir(current.common_hooks + "build_packages/common", staging.hooks + "build_packages", just_contents=True)
-        
-        # sdk-specific materials; can but shouldn't override (conflict with)
-        # files already copied that are common to all SDKs
-        utils.cp_dir(current.common_files + f"system_config/{self.name}", staging.files + "system_config", just_contents=True)
-        utils.cp_dir(current.common_files + f"sdk_config/{self.name}", staging.files + "sdk_config", just_contents=True)
-        utils.cp_dir(current.common_scripts + f"prebuild/{self.name}", staging.scripts + "prebuild", just_contents=True)
-        utils.cp_dir(current.common_scripts + f"build/{self.name}", staging.scripts + "build", just_contents=True)
-        utils.cp_dir(current.common_scripts + f"postbuild/{self.name}", staging.scripts + "postbuild", just_contents=True)
-        utils.cp_dir(current.common_hooks + f"build_packages/{self.name}", staging.scripts + "hooks/build_packages", just_contents=True)
-        utils.cp_dir(current.common_hooks + f"install_configs/{self.name}", staging.scripts + "hooks/install_configs", just_contents=True)
-        utils.cp_dir(current.common_hooks + f"prepare_system/{self.name}", staging.scripts + "hooks/prepare_system", just_contents=True)
-        utils.cp_dir(current.common_hooks + f"prepare_sdk/{self.name}", staging.scripts + "hooks/prepare_sdk", just_contents=True)
-
-        # overrides or target-specific files
-        utils.cp_dir(current.target_files, staging.basedir)
-        utils.cp_dir(current.target_scripts, staging.basedir)
-
-        for pyfile in glob.glob("*.py"):
-            shutil.copy2(pyfile, staging.basedir)
+        src      = current.resolve_many([
+            'depends', 'schemas', 'steps_dir', 'tgspec', 'env_defaults',
+            'common_files', 'common_scripts', 'common_hooks', 'target_files', 'target_scripts'
+            ])
+        dst      = current.resolve_many([
+            'basedir', 'depends', 'schemas', 'steps_dir', 'target', 'common',
+            'files', 'scripts', 'hooks'
+            ], context='staging')
+
+        with os.scandir('.') as it:
+            pyfiles = [e.name for e in it if e.name.endswith(".py") and not e.name.startswith('.') and e.is_file()]
+
+        # automated builds only ADD staging into the image, so hardlinks can stand
+        # in for copies there. Dev builds and interactive containers bind mount
+        # it read-write, and writes through a hardlink would land in the repo
+        hardlink  = self.conf["sdk_build_type"] != "dev"
+
+        # skip the copies entirely if neither the sources nor the staged files
+        # have changed since the staging directory was last populated (the same
+        # way); staging is mounted read-write in dev containers so it is checked too
+        sigfile   = dst["basedir"] + ".staging.sig"
+        signature = ("hardlinked:" if hardlink else "copied:") + utils.get_tree_digest([
+            src["depends"], src["schemas"], src["steps_dir"], src["tgspec"], src["env_defaults"],
+            src["common_files"], src["common_scripts"], src["target_files"], src["target_scripts"],
+            *sorted(pyfiles)
+            ])
+
+        def get_staged_digest():
+            with os.scandir(dst["basedir"]) as it:
+                staged = sorted(e.path for e in it if e.path != sigfile)
+            return utils.get_tree_digest(staged)
+
+        if not (force or self.conf["start_clean"]):
+            try:
+                with open(sigfile) as f:
+                    if f.read() == f"{signature}\n{get_staged_digest()}":
+                        utils.log(" > Staging directory is up to date")
+                        return
+            except FileNotFoundError:
+                pass
+
+        shutil.rmtree(dst["basedir"], ignore_errors=True)
+        os.mkdir(dst["basedir"])
+
+        # the target-specific overrides below are always real copies
+        contents = {"just_contents": True, "hardlink_safe": hardlink}
+        must_exist = {"must_exist": True, "hardlink_safe": hardlink}
+
+        # the copies are independent of one another (copies into the same
+        # directory are still done in order) so they are run concurrently
+        utils.run_copy_jobs([
+            # bare sdk files to continue inside container
+            (utils.cp_dir, src["depends"], dst["depends"], contents),
+            (utils.cp_dir, src["schemas"], dst["schemas"], contents),
+            (utils.cp_dir, src["steps_dir"], dst["steps_dir"], contents),
+            (utils.cp_file, src["tgspec"], dst["target"], must_exist),
+            (utils.cp_file, src["env_defaults"], dst["common"] + 'specs/', must_exist),
+            (utils.cp_file, src["common_hooks"] + "run_hooks.py", dst["hooks"], must_exist),
+
+            # common build materials
+            (utils.cp_dir, src["common_files"] + f"system_config/common", dst["files"] + "system_config", contents),
+            (utils.cp_dir, src["common_files"] + f"sdk_config/common", dst["files"] + "system_config", contents),
+            (utils.cp_dir, src["common_scripts"] + "prebuild/common", dst["scripts"] + "prebuild", contents),
+            (utils.cp_dir, src["common_scripts"] + "build/common", dst["scripts"] + "build", contents),
+            (utils.cp_dir, src["common_scripts"] + "postbuild/common", dst["scripts"] + "postbuild", contents),
+            (utils.cp_dir, src["common_hooks"] + "prepare_system/common", dst["hooks"] + "prepare_system", contents),
+            (utils.cp_dir, src["common_hooks"] + "prepare_sdk/common", dst["hooks"] + "prepare_sdk", contents),
+            (utils.cp_dir, src["common_hooks"] + "install_configs/common", dst["hooks"] + "install_configs", contents),
+            (utils.cp_dir, src["common_hooks"] + "build_packages/common", dst["hooks"] + "build_packages", contents),
+
+            # sdk-specific materials; can but shouldn't override (conflict with)
+            # files already copied that are common to all SDKs
+            (utils.cp_dir, src["common_files"] + f"system_config/{self.name}", dst["files"] + "system_config", contents),
+            (utils.cp_dir, src["common_files"] + f"sdk_config/{self.name}", dst["files"] + "sdk_config", contents),
+            (utils.cp_dir, src["common_scripts"] + f"prebuild/{self.name}", dst["scripts"] + "prebuild", contents),
+            (utils.cp_dir, src["common_scripts"] + f"build/{self.name}", dst["scripts"] + "build", contents),
+            (utils.cp_dir, src["common_scripts"] + f"postbuild/{self.name}", dst["scripts"] + "postbuild", contents),
+            (utils.cp_dir, src["common_hooks"] + f"build_packages/{self.name}", dst["scripts"] + "hooks/build_packages", contents),
+            (utils.cp_dir, src["common_hooks"] + f"install_configs/{self.name}", dst["scripts"] + "hooks/install_configs", contents),
+            (utils.cp_dir, src["common_hooks"] + f"prepare_system/{self.name}", dst["scripts"] + "hooks/prepare_system", contents),
+            (utils.cp_dir, src["common_hooks"] + f"prepare_sdk/{self.name}", dst["scripts"] + "hooks/prepare_sdk", contents),
+            ])
+
+        # overrides or target-specific files; only copied once everything above is in place
+        utils.run_copy_jobs(
+            [(utils.cp_dir, src["target_files"], dst["basedir"], {}),
+             (utils.cp_dir, src["target_scripts"], dst["basedir"], {})] +
+            [(utils.cp_file, pyfile, dst["basedir"], {}) for pyfile in pyfiles]
+            )
+
+        with open(sigfile, "w") as f:
+            f.write(f"{signature}\n{get_staged_digest()}")
 
     def system_prepare(self):
         pass
@@ -340,8 +471,8 @@ class Concrete_sdk(Sdk):
     def run_hook(self, hook):
         script_name = "run_hooks.py"
         hooks_dir = self.paths.hooks
-        cmd  = hooks_dir + script_name + f" {hook}"
-        utils.log(f" => [Hook runner] {cmd}")
+        cmd  = [hooks_dir + script_name, hook]
+        utils.log(f" => [Hook runner] {shlex.join(cmd)}")
         utils.run(cmd, env=self.get_env_vars())
 
     def install_configs(self):
@@ -353,17 +484,25 @@ class Concrete_sdk(Sdk):
     def prepare_sdk(self):
         self.run_hook("prepare_sdk")
 
+    @functools.cached_property
+    def task_table(self):
+        """
+        Map each build step in the steps enum the step files are validated
+        against to the method carrying it out (None if there isn't one).
+        """
+        steps = utils.load_json_from_file(self.paths.schemas + "enum/steps.json")["enum"]
+        return {step : getattr(self, step, None) for step in steps}
+
     def execute_task(self, task):
-        method = getattr(self, task, None)
-        errmsg = f"{task} does not identify an Sdk method"
-        if not method:
-            raise LookupError(errmsg)
-        if not callable(method):
-            raise TypeError(errmsg)
+        try:
+            method = self.task_table[task]
+        except KeyError:
+            raise LookupError(f"{task} does not identify an Sdk task") from None
+        if method is None:
+            raise NotImplementedError(f"No implementation for the '{task}' step")
         method()
     
     def get_time_string(self):
-        time = datetime.now()
         return time.strftime("%b %d %Y ~ %H:%M")
 
     def save(self, s, path):
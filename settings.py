@@ -6,6 +6,19 @@ import sys
 import utils
 import containers
 
+class Pathentry():
+    """
+    A path as stored in a Pathmap: path is relative to the parent label,
+    if any. resolved holds the full path once it has been looked up.
+    """
+    __slots__ = ("path", "parent", "isfile", "resolved")
+
+    def __init__(self, path, parent=None, isfile=False):
+        self.path     = path
+        self.parent   = parent
+        self.isfile   = isfile
+        self.resolved = None
+
 class Pathmap():
     """
     This project operates, in terms of paths, in three distinct contexts:
@@ -27,7 +40,7 @@ class Pathmap():
      
     def add_context(self, context, basedir, label='basedir'):
         self.contexts[context] = {}
-        self.contexts[context]["basedir"] = { "path" : basedir, "parent": None}
+        self.contexts[context]["basedir"] = Pathentry(basedir)
 
     def set_current_context(self, context):
         if not context or context == 'all':
@@ -49,14 +62,22 @@ class Pathmap():
             if nothrows:
                 return False
             raise LookupError(f"No such path '{label}' in context '{context}'")
-        pathconf = self.contexts[context][label]
-        path    = pathconf["path"]
-        if not pathconf.get('isfile'):
-            path = utils.ensure_dir_semantics(path)
-        parent  = pathconf.get('parent')
-        if parent:
-            path = self.get(context=context, label=parent) + path
-        return path
+        paths = self.contexts[context]
+        first = entry = paths[label]
+        # walk up the parent chain, then put the path together in one go
+        parts = []
+        while not entry.resolved:
+            parts.append(entry.path if entry.isfile else utils.ensure_dir_semantics(entry.path))
+            if not entry.parent:
+                break
+            parent = entry.parent
+            entry  = paths.get(parent)
+            if not entry:
+                raise LookupError(f"No such path '{parent}' in context '{context}'")
+        else:
+            parts.append(entry.resolved)
+        first.resolved = ''.join(reversed(parts))
+        return first.resolved
 
     def set(self, context, label, path, relativeto=None, isfile=False):
         listspec = context.split(';')
@@ -64,7 +85,40 @@ class Pathmap():
             self.check_context(context)
             contexts = self.contexts if context=='all' else {context : self.contexts[context]}
             for paths in contexts.values():
-                paths[label] = {"path" : path, "parent": relativeto, "isfile": isfile}
+                paths[label] = Pathentry(path, relativeto, isfile)
+        # paths relative to the one just set may resolve differently now
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Forget all resolved paths; they are recomputed on the next lookup.
+        """
+        for paths in self.contexts.values():
+            for entry in paths.values():
+                entry.resolved = None
+
+    def resolve_all(self):
+        """
+        Resolve every path in every context up front so that later lookups
+        are a single dictionary access. Paths that cannot be resolved (e.g.
+        relative to a parent missing from that context, or the target path
+        when no target was given) are left alone and raise on lookup as usual.
+        """
+        for context, paths in self.contexts.items():
+            for label in paths:
+                try:
+                    self.get(context, label)
+                except (LookupError, TypeError):
+                    pass
+    
+    def resolve_many(self, labels, context=None):
+        """
+        Look up several labels in one go. Returns a dict mapping
+        each label to its path in context (or the current context).
+        """
+        context = context or self.context
+        self.check_context(context)
+        return {label : self.get(context, label) for label in labels}
     
     def clone(self, context=None):
         clone = Pathmap()
@@ -120,6 +174,7 @@ def set_paths(target):
     paths.set(context='staging;container', label='scripts', path='scripts', relativeto='basedir')
     paths.set(context='staging;container', label='hooks', path='hooks', relativeto='scripts')
     paths.set(context='staging;container', label='depends', path='depends', relativeto='basedir')
+    paths.resolve_all()
     return paths
 
 
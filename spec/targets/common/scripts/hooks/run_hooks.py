@@ -6,7 +6,8 @@ import sys
 import utils
 
 def list_known_hooks(hooks_dir):
-    return [x for x in os.listdir(hooks_dir) if os.path.isdir(hooks_dir+'/'+x)]
+    with os.scandir(hooks_dir) as it:
+        return [x.name for x in it if x.is_dir()]
 
 
 utils.STREAM_LOGGING_ON__ = bool(os.getenv("VERBOSE"))
@@ -15,7 +16,8 @@ hook = sys.argv[1] if len(sys.argv)>1 and sys.argv[1] else None
 
 hooks_dir = os.path.dirname(os.path.realpath(__file__)) + '/'
 hook_dir  = hooks_dir + hook
-utils.log(f" ** Known hooks: {list_known_hooks(hooks_dir)}")
+if os.getenv("VERBOSE"):
+    utils.log(f" ** Known hooks: {list_known_hooks(hooks_dir)}")
 
 if not hook:
     utils.log("FATAL: Hook not specified")
@@ -26,7 +28,5 @@ elif not utils.has_scripts(hook_dir):
 else:
     utils.log(f" > Running scripts for hook '{hook}'")
     scripts = utils.get_sorted_script_list(hook_dir)
-    for script in scripts:
-        basename = os.path.basename(script)
-        utils.log(f"Runninng {basename} [hook='{hook}']")
-        utils.run( f"{script}", capture=not bool(os.getenv("VERBOSE")) )
+    utils.log(f"Running {[os.path.basename(x) for x in scripts]} [hook='{hook}']")
+    utils.run_script_chain(scripts, capture=not bool(os.getenv("VERBOSE")))
@@ -4,25 +4,50 @@
 Helper functions
 """
 import os
+import errno
+import stat
 import sys
 import shutil
+import functools
+import concurrent.futures
+import hashlib
 import pathlib
 import json
 import jsonschema
 import subprocess
 import tarfile
 import tempfile
+import threading
 import re
+import shlex
 
 STREAM_LOGGING_ON = False
 FILE_LOGGING_ON   = False
 LOGFILE           = ".tmp/build.log"
 
+# most bytes handed to a single copy_file_range() call
+COPY_RANGE_SIZE = 1 << 30
+
+VALIDATION_CACHE_ON = False
+VALIDATION_CACHE    = os.path.expanduser("~/.cache/builder/validated.json")
+VALIDATION_CACHE_LOCK = threading.Lock()
+
+# a RefResolver keeps state while validating so validators are not shared between threads
+VALIDATORS = threading.local()
+
 def set_logging(tostdout=False, tofile=False):
     global STREAM_LOGGING_ON, FILE_LOGGING_ON
     STREAM_LOGGING_ON = tostdout
     FILE_LOGGING_ON   = tofile
 
+def set_validation_cache(enabled=False):
+    """
+    When enabled, json files that have previously passed validation are not
+    validated again as long as neither they nor the schemas have changed since.
+    """
+    global VALIDATION_CACHE_ON
+    VALIDATION_CACHE_ON = enabled
+
 def strip_sgr(s):
     """ Strip ANSI SGR sequences from string and return it """
     pattern = r'(?:\x1B[@-Z\\-_]|[\x80-\x9A\x9C-\x9F]|(?:\x1B\[|\x9B)[0-?]*[ -/]*[@-~])'
@@ -49,6 +74,26 @@ def log(msg, cond=None):
         with open(LOGFILE, "a") as f:
             f.write(msg + '\n')
 
+def log_stream(lines, cond=None):
+    """
+    Like log() but for an iterable of lines, e.g. the output of a build.
+    The logfile is opened once for the whole stream rather than per line.
+    """
+    if cond != None and not cond:
+        return
+    # line buffered so the logfile can still be followed as the build goes
+    logfile = open(LOGFILE, "a", buffering=1) if FILE_LOGGING_ON else None
+    try:
+        for line in lines:
+            line = strip_quoted_newlines(strip_sgr(line))
+            if STREAM_LOGGING_ON:
+                print(line, flush=True)
+            if logfile:
+                logfile.write(line + '\n')
+    finally:
+        if logfile:
+            logfile.close()
+
 def dedup(s, c, keep_last=True):
     append = s[-1] if (keep_last and s[-1] == c) else ''
     parts = [x for x in s.split(c) if x]
@@ -71,50 +116,260 @@ def ensure_dir_semantics(path):
 def get_project_root():
     return os.path.dirname(os.path.realpath(__file__)) + '/'
 
-def cp_dir(src_dir, dst_dir, empty_first=False, just_contents=False):
+def copy_file_data(src, dst):
+    """
+    Copy the contents of the file src to dst. Where supported this is done
+    in the kernel with copy_file_range(), without passing the data through
+    userspace, else it falls back to a regular read/write copy.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if hasattr(os, "copy_file_range"):
+            size   = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            try:
+                while True:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_RANGE_SIZE)
+                    if not n:
+                        break
+                    copied += n
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+            # some filesystems (procfs-like files, some FUSE mounts) report
+            # EOF straight away for files that aren't empty: unless all of
+            # the file was seen to be copied, start over the regular way
+            if size and copied >= size:
+                return
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst)
+
+def copy_file(src, dst, hardlink=False):
+    """
+    Copy the file src to the path dst, replacing dst if it exists.
+
+    dst is always unlinked first rather than written to. Otherwise a
+    copy over a hardlinked file would modify the original as well.
+    If hardlink=True, dst is made a hardlink to src when possible,
+    falling back to a normal copy e.g. across filesystems.
+    """
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    if hardlink:
+        try:
+            return os.link(src, dst)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+                raise
+    copy_file_data(src, dst)
+    shutil.copystat(src, dst)
+
+def cp_dir(src_dir, dst_dir, empty_first=False, just_contents=False, hardlink_safe=False):
     """
     cp the directory a to inside b. The whole directory is copied,
     not just the contents.
     All the path components are created if they
     do not exist.
+    If hardlink_safe=True, the files are hardlinked rather than copied
+    where possible. Only use this when the copies won't be modified.
     """
     dst = dst_dir
     if not just_contents:
         dst = dst_dir + "/" + get_last_path_component(src_dir)
-    if os.path.exists(dst):
-        if os.path.isdir(dst) and empty_first:
+    try:
+        mode = os.stat(dst).st_mode
+    except FileNotFoundError:
+        mode = None
+    if mode is not None:
+        if stat.S_ISDIR(mode) and empty_first:
             shutil.rmtree(dst)
-        elif os.path.isfile(dst):
+        elif stat.S_ISREG(mode):
             raise NotADirectoryError("Source directory is a file!")
-    os.makedirs(dst, exist_ok=True)
-    shutil.copytree(src_dir, dst, dirs_exist_ok=True)
+    # copytree creates dst and any missing parents itself
+    copy_function = functools.partial(copy_file, hardlink=hardlink_safe)
+    shutil.copytree(src_dir, dst, dirs_exist_ok=True, copy_function=copy_function)
 
-def cp_file(src_file, dst_dir, dst_fname=None, make_dirs=True, must_exist=False):
+def cp_file(src_file, dst_dir, dst_fname=None, make_dirs=True, must_exist=False, hardlink_safe=False):
     if not os.path.isfile(src_file):
         if must_exist:
             raise FileNotFoundError
         return
     if make_dirs:
         os.makedirs(dst_dir, exist_ok=True)
-    shutil.copy2(src_file, dst_dir + "/" + (dst_fname or ''))
+    copy_file(src_file, os.path.join(dst_dir, dst_fname or os.path.basename(src_file)), hardlink=hardlink_safe)
+
+def get_tree_digest(paths):
+    """
+    Return a digest of the path, size and modification time of each of the
+    paths and, for directories, of everything under them. File contents
+    are not read so this is cheap, but it changes whenever a file is
+    modified, added or removed. Paths that don't exist are allowed.
+    """
+    digest = hashlib.sha256()
+
+    def add(path, st):
+        digest.update(f"{path}\0{st.st_mtime_ns}\0{st.st_size}\n".encode())
+
+    def walk(dirpath):
+        with os.scandir(dirpath) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            add(entry.path, entry.stat())
+            if entry.is_dir():
+                walk(entry.path)
+
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            digest.update(f"{path}\0\n".encode())
+            continue
+        add(path, st)
+        if stat.S_ISDIR(st.st_mode):
+            walk(path)
+    return digest.hexdigest()
+
+def run_copy_jobs(jobs, max_workers=None):
+    """
+    Run copy jobs concurrently on a thread pool.
+
+    :param jobs         list of (func, src, dst, kwargs) tuples; each job is run
+                        as func(src, dst, **kwargs). Jobs with the same destination
+                        are run one after the other, in list order, so that later
+                        copies still override earlier ones. All other jobs run in parallel.
+    :param max_workers  size of the thread pool. Copies spend most of their time
+                        in syscalls so by default there are more threads than cpus.
+
+    Any exception raised by a job is propagated once all jobs have finished.
+    """
+    groups = {}
+    for job in jobs:
+        groups.setdefault(os.path.normpath(job[2]), []).append(job)
+
+    def run_group(group):
+        for func, src, dst, kwargs in group:
+            func(src, dst, **kwargs)
+
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) * 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_group, group) for group in groups.values()]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 def load_json_from_file(path):
     with open(path, "r", encoding='utf8') as fh:
         return json.load(fh)
 
-def validate_json_against_schema(instancefile, schemas_dir):
-    instance     = load_json_from_file(instancefile)
-    schemafile   = schemas_dir + f"{instance['schema']}"
-    schema       = load_json_from_file(schemafile)
+@functools.lru_cache(maxsize=None)
+def load_schema(schemafile):
+    """
+    Load and check the schema at schemafile. Each schema is only checked once.
+    """
+    schema = load_json_from_file(schemafile)
+    jsonschema.validators.validator_for(schema).check_schema(schema)
+    return schema
+
+def get_validator(schemafile, schemas_dir):
+    """
+    Return a validator for the schema at schemafile. Validators are built
+    once per schema and thread and reused for every later call.
+    """
+    validators = getattr(VALIDATORS, "cache", None)
+    if validators is None:
+        validators = VALIDATORS.cache = {}
+    validator = validators.get((schemafile, schemas_dir))
+    if validator is not None:
+        return validator
+
+    schema = load_schema(schemafile)
 
     # add trailing slash, see
     # https://python-jsonschema.readthedocs.io/en/stable/faq/#how-do-i-configure-a-base-uri-for-ref-resolution-using-local-files
     schemas_path = pathlib.Path(schemas_dir).absolute().as_uri() + '/'
 
     relref_resolver = jsonschema.validators.RefResolver(base_uri=schemas_path, referrer=True)
+    validator = jsonschema.validators.validator_for(schema)(schema, resolver=relref_resolver)
+    validators[(schemafile, schemas_dir)] = validator
+    return validator
+
+@functools.lru_cache(maxsize=None)
+def load_validation_cache():
+    """
+    Load the record of previously validated files. The record has two parts:
+     - files: maps a path to its [mtime_ns, size, digest] as last seen.
+     - validated: maps an instance path to the digest it last passed validation with.
+    """
+    try:
+        cache = load_json_from_file(VALIDATION_CACHE)
+    except (OSError, ValueError):
+        cache = {}
+    cache.setdefault("files", {})
+    cache.setdefault("validated", {})
+    return cache
+
+def save_validation_cache():
+    cache = load_validation_cache()
+    os.makedirs(os.path.dirname(VALIDATION_CACHE), exist_ok=True)
+    tmpfile = VALIDATION_CACHE + ".tmp"
+    with open(tmpfile, "w", encoding='utf8') as fh:
+        json.dump(cache, fh)
+    os.replace(tmpfile, VALIDATION_CACHE)
+
+def get_file_digest(path):
+    """
+    Return a short blake2b digest of the contents of the file at path.
+    The file is only read and hashed if its mtime or size changed since
+    the digest was last recorded.
+    """
+    digests = load_validation_cache()["files"]
+    st      = os.stat(path)
+    record  = digests.get(path)
+    if record and record[0] == st.st_mtime_ns and record[1] == st.st_size:
+        return record[2]
+    with open(path, "rb") as fh:
+        digest = hashlib.blake2b(fh.read(), digest_size=8).hexdigest()
+    digests[path] = [st.st_mtime_ns, st.st_size, digest]
+    return digest
+
+@functools.lru_cache(maxsize=None)
+def get_schemas_digest(schemas_dir):
+    """
+    Digest of every schema under schemas_dir: schemas reference each other
+    so a change to any of them can change the outcome of a validation.
+    """
+    schemas = sorted(os.path.join(root, f) for root, _, files in os.walk(schemas_dir) for f in files)
+    digests = ''.join(get_file_digest(os.path.abspath(schema)) for schema in schemas)
+    return hashlib.blake2b(digests.encode(), digest_size=8).hexdigest()
+
+def get_validation_digest(instancefile, schemas_dir):
+    return get_file_digest(instancefile) + get_schemas_digest(schemas_dir)
+
+def validate_json_against_schema(instancefile, schemas_dir, instance=None):
+    """
+    Validate the json in instancefile against the schema it names and return it.
+    If the caller has already parsed instancefile, the result can be passed in
+    as instance to avoid reading the file a second time.
+    """
+    if instance is None:
+        instance = load_json_from_file(instancefile)
+    schemafile   = schemas_dir + f"{instance['schema']}"
+
+    if VALIDATION_CACHE_ON:
+        abspath = os.path.abspath(instancefile)
+        with VALIDATION_CACHE_LOCK:
+            digest  = get_validation_digest(abspath, schemas_dir)
+            if load_validation_cache()["validated"].get(abspath) == digest:
+                return instance
 
     try:
-        jsonschema.validate(instance, schema, resolver=relref_resolver)
+        # report the most relevant error, as jsonschema.validate() does
+        validator = get_validator(schemafile, schemas_dir)
+        error = jsonschema.exceptions.best_match(validator.iter_errors(instance))
+        if error is not None:
+            raise error
     except jsonschema.exceptions.ValidationError as e :
         print(f"Instance {instancefile} is invalid against schema {schemafile}")
         raise
@@ -122,13 +377,18 @@ def validate_json_against_schema(instancefile, schemas_dir):
         print(f"Failed to validate {instancefile} -- invalid schema('{schemafile}')")
         raise
     else:
+        if VALIDATION_CACHE_ON:
+            with VALIDATION_CACHE_LOCK:
+                load_validation_cache()["validated"][abspath] = digest
+                save_validation_cache()
         return instance
 
 def run(cmd, env=None, capture=False, timeout=None):
     """
-    Run cmd in subshell with the specified environment.
+    Run cmd with the specified environment.
 
-    :param cmd:       command to run in a subshell.
+    :param cmd:       command to run. A string is run in a subshell; a list of
+                      arguments is executed directly, without going through a shell.
     :param env:       the environment to execute cmd with. If not specified,
                       the environment is inherited from the parent shell.
     :param capture:   whether to capture the stdout and stderr streams of the subprocess.
@@ -147,12 +407,14 @@ def run(cmd, env=None, capture=False, timeout=None):
                 text=True,
                 timeout=timeout,
                 check=True,
-                shell=True,
+                shell=isinstance(cmd, str),
                 stdout = subprocess.PIPE if capture else sys.stderr,
                 stderr = subprocess.STDOUT,
                 env=env
                 )
     except subprocess.CalledProcessError as e:
+        if not isinstance(cmd, str):
+            cmd = shlex.join(cmd)
         if capture:
             output = e.stdout.strip()
             print(f' !! Command "{cmd}" failed with error code {e.returncode}: \n<<{output}>>')
@@ -163,6 +425,7 @@ def run(cmd, env=None, capture=False, timeout=None):
         return (proc_completed.returncode, proc_completed.stdout)
 
 def interact(cmd, env=None, timeout=None):
+    # cmd is a string run in a subshell or a list of arguments, as for run().
     # note you DO NOT want to have the communication with the child proxied
     # via pipes. Docker will complain the driving program is not a tty. Instead,
     # simply interact with the program by connecting it directly to the standard streams.
@@ -172,7 +435,7 @@ def interact(cmd, env=None, timeout=None):
                 text=True,
                 timeout=timeout,
                 check=True,
-                shell=True,
+                shell=isinstance(cmd, str),
                 stdout = sys.stdout,
                 stderr = sys.stderr,
                 stdin  = sys.stdin,
@@ -188,6 +451,21 @@ def run_commands(cmds, env=None, cb=None, verbose=True):
         if cb:
             cb(r)
 
+def run_script_chain(scripts, env=None, capture=False):
+    """
+    Run the scripts in order in a single shell rather than one shell per
+    script. As with run_commands, the first script to fail stops the chain
+    and its exit code is raised as a CalledProcessError. Each script is
+    announced in the output before it runs so a failure can be traced to it.
+    """
+    if not scripts:
+        return (0, None)
+    chain = []
+    for script in scripts:
+        chain.append("echo " + shlex.quote(f" > Running {os.path.basename(script)}"))
+        chain.append(shlex.quote(script))
+    return run(" && ".join(chain), env, capture=capture)
+
 def is_executable(file):
     return os.path.isfile(file) and os.access(file, os.X_OK)
 